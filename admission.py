@@ -0,0 +1,191 @@
+import asyncio, os, time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from router import normalize_site
+
+load_dotenv()
+
+# Process-wide limits. A slot is held for the whole request, including the up-to-10s
+# Google call during which /metrics holds no DB connection, so sizing this to the DB pool
+# would shed requests while the pool sits idle. The default is instead anyio's threadpool
+# size (40): that is where the sync endpoints and the /metrics lookup run their queries,
+# so a briefly exhausted pool makes those threads wait, not the event loop.
+MAX_CONCURRENCY = int(os.getenv("GSC_MAX_CONCURRENCY", "40"))
+MAX_QUEUE = int(os.getenv("GSC_MAX_QUEUE", "50"))
+
+# Per-tenant limits, keyed by the normalized site_url of the request
+TENANT_CONCURRENCY = int(os.getenv("GSC_TENANT_CONCURRENCY", "4"))
+TENANT_QUEUE = int(os.getenv("GSC_TENANT_QUEUE", "8"))
+
+QUEUE_TIMEOUT = float(os.getenv("GSC_QUEUE_TIMEOUT", "5"))
+RETRY_AFTER_SECONDS = 1
+
+ADMISSION_PREFIX = "/api/v1/gsc"
+# Google's OAuth redirect carries a one-time code and browsers won't honour Retry-After,
+# so shedding it would force the user through consent again
+ADMISSION_EXEMPT_PATHS = {f"{ADMISSION_PREFIX}/callback"}
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, reason: str, wait: float):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.wait = wait
+
+
+class _Gate:
+    """A concurrency limit with a bounded wait queue in front of it."""
+
+    def __init__(self, limit: int, max_queue: int):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiting = 0
+
+    async def acquire(self, timeout: float) -> bool:
+        if not self.semaphore.locked():
+            await self.semaphore.acquire()
+            self.active += 1
+            return True
+
+        if self.waiting >= self.max_queue:
+            return False
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        self.semaphore.release()
+
+    @property
+    def idle(self) -> bool:
+        return self.active == 0 and self.waiting == 0
+
+
+class AdmissionController:
+    def __init__(self):
+        self.global_gate = _Gate(MAX_CONCURRENCY, MAX_QUEUE)
+        self.tenant_gates: Dict[str, _Gate] = {}
+        self.queue_waits = deque(maxlen=1000)
+        self.shed = {"tenant": 0, "global": 0}
+
+    @asynccontextmanager
+    async def slot(self, tenant: Optional[str]):
+        """Holds a tenant slot and a global slot for the duration of a request; yields the queue wait."""
+        started = time.monotonic()
+
+        # Take the tenant slot first so a noisy tenant queues on its own gate
+        # instead of sitting on global capacity everyone else needs.
+        tenant_gate = None
+        if tenant:
+            tenant_gate = self.tenant_gates.setdefault(tenant, _Gate(TENANT_CONCURRENCY, TENANT_QUEUE))
+            try:
+                admitted = await tenant_gate.acquire(QUEUE_TIMEOUT)
+            except BaseException:
+                self._drop_if_idle(tenant)
+                raise
+            if not admitted:
+                self._drop_if_idle(tenant)
+                self.shed["tenant"] += 1
+                raise AdmissionRejected(
+                    429, "Too many concurrent requests for this site", time.monotonic() - started
+                )
+
+        remaining = max(0.0, QUEUE_TIMEOUT - (time.monotonic() - started))
+        try:
+            admitted = await self.global_gate.acquire(remaining)
+        except BaseException:
+            # Cancelled while queued (client gone, shutdown): hand the tenant slot back
+            if tenant_gate:
+                tenant_gate.release()
+                self._drop_if_idle(tenant)
+            raise
+        if not admitted:
+            if tenant_gate:
+                tenant_gate.release()
+                self._drop_if_idle(tenant)
+            self.shed["global"] += 1
+            raise AdmissionRejected(503, "Server is overloaded", time.monotonic() - started)
+
+        wait = time.monotonic() - started
+        self.queue_waits.append(wait)
+        try:
+            yield wait
+        finally:
+            self.global_gate.release()
+            if tenant_gate:
+                tenant_gate.release()
+                self._drop_if_idle(tenant)
+
+    def _drop_if_idle(self, tenant: str):
+        gate = self.tenant_gates.get(tenant)
+        if gate and gate.idle:
+            del self.tenant_gates[tenant]
+
+    def stats(self) -> dict:
+        waits = sorted(self.queue_waits)
+
+        def pct(p: float) -> float:
+            if not waits:
+                return 0.0
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))] * 1000, 2)
+
+        return {
+            "active": self.global_gate.active,
+            "queued": self.global_gate.waiting,
+            "max_concurrency": MAX_CONCURRENCY,
+            "max_queue": MAX_QUEUE,
+            "tenants_active": len(self.tenant_gates),
+            "shed": dict(self.shed),
+            "queue_wait_ms": {"p50": pct(0.5), "p95": pct(0.95), "p99": pct(0.99), "max": pct(1.0)},
+        }
+
+
+admission_controller = AdmissionController()
+
+
+class AdmissionControlMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, controller: AdmissionController = admission_controller):
+        super().__init__(app)
+        self.controller = controller
+
+    async def dispatch(self, request: Request, call_next):
+        path = request.url.path
+        if not path.startswith(ADMISSION_PREFIX) or path.rstrip("/") in ADMISSION_EXEMPT_PATHS:
+            return await call_next(request)
+
+        site_url = request.query_params.get("site_url")
+        tenant = normalize_site(site_url) if site_url else None
+
+        try:
+            async with self.controller.slot(tenant) as wait:
+                response = await call_next(request)
+        except AdmissionRejected as e:
+            return JSONResponse(
+                status_code=e.status_code,
+                content={"detail": e.reason},
+                headers={
+                    "Retry-After": str(RETRY_AFTER_SECONDS),
+                    "X-Queue-Wait-Ms": f"{e.wait * 1000:.1f}"
+                }
+            )
+
+        response.headers["X-Queue-Wait-Ms"] = f"{wait * 1000:.1f}"
+        return response
@@ -1,18 +1,56 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
 
 from db import engine, Base
 import models
 import router
+from upstream import CircuitOpenError
+from admission import AdmissionControlMiddleware, admission_controller
+from token_refresher import token_refresher
 
 Base.metadata.create_all(bind=engine)
-app = FastAPI()
+
+# create_all won't add columns to an existing table; bring older deployments up to models.py
+if engine.dialect.name == "postgresql":
+    with engine.begin() as conn:
+        conn.execute(text(
+            "ALTER TABLE gsc_verifications ADD COLUMN IF NOT EXISTS token_expires_at TIMESTAMPTZ"
+        ))
+        conn.execute(text(
+            "ALTER TABLE gsc_verifications ADD COLUMN IF NOT EXISTS refresh_token_invalid BOOLEAN DEFAULT FALSE"
+        ))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    token_refresher.start()
+    yield
+    await token_refresher.stop()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(AdmissionControlMiddleware, controller=admission_controller)
 
 app.include_router(router.gsc_router)
 
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request: Request, exc: CircuitOpenError):
+    # Fail fast instead of waiting out the upstream timeout
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
 @app.get("/")
 def root():
     return {"message": "Welcome to the GSC API"}
 
+@app.get("/admission")
+def admission_stats():
+    # Current load and queue wait percentiles (also sent per response as X-Queue-Wait-Ms)
+    return admission_controller.stats()
+
 @app.get("/help")
 def help():
     return{
@@ -20,6 +58,7 @@ def help():
             "request-verification": "POST /api/v1/gsc/request-verification",
             "callback": "GET /api/v1/gsc/callback",
             "verify-result": "GET /api/v1/gsc/verify-result",
+            "verify-result-batch": "POST /api/v1/gsc/verify-result/batch",
             "metrics": "GET /api/v1/gsc/metrics",
             "disconnect": "DELETE /api/v1/gsc/disconnect"
         },
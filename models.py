@@ -20,5 +20,7 @@ class GSCVerification(Base):
 
     access_token = Column(Text, nullable=True)
     refresh_token = Column(Text, nullable=True)
+    token_expires_at = Column(DateTime(timezone=True), nullable=True)
+    refresh_token_invalid = Column(Boolean, default=False)  # set when Google answers invalid_grant
     
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -1,14 +1,34 @@
-import os, requests, httpx
+import os, json, time, asyncio, requests, httpx
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from uuid import UUID
 from dotenv import load_dotenv
 from fastapi import APIRouter, Depends, Request, Query, HTTPException, status
-from fastapi.responses import RedirectResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, RedirectResponse
 from sqlalchemy.orm import Session
 from urllib.parse import urlencode, quote
 from sqlalchemy import text
+try:
+    from sqlalchemy.dialects.postgresql import distinct_on
+except ImportError:  # SQLAlchemy < 2.1 only has the Query.distinct(expr) form
+    distinct_on = None
 from models import GSCVerification
-from schemas import GSCVerificationCreate, GSCVerificationResult
-from db import get_db
-from typing import List, Optional
+from schemas import (
+    GSCVerificationCreate,
+    GSCVerificationResult,
+    GSCVerificationBatchRequest,
+    GSCVerificationBatchResult,
+)
+from db import SessionLocal, get_db
+from upstream import (
+    CircuitOpenError,
+    TOKEN_UPSTREAM,
+    USER_INFO_UPSTREAM,
+    SITES_UPSTREAM,
+    QUERY_UPSTREAM,
+)
+from typing import Dict, List, Optional
 
 load_dotenv()
 gsc_router = APIRouter(prefix="/api/v1/gsc", tags=["GSC"])
@@ -244,7 +264,9 @@ async def gsc_callback(request: Request, db: Session = Depends(get_db)):
 
     async with httpx.AsyncClient(timeout=TIMEOUT) as client:
         # 2. Exchange code for tokens
-        token_res = await client.post(
+        token_res = await TOKEN_UPSTREAM.request(
+            client,
+            "POST",
             TOKEN_URL,
             data={
                 "client_id": CLIENT_ID,
@@ -263,14 +285,22 @@ async def gsc_callback(request: Request, db: Session = Depends(get_db)):
         refresh_token = token_data.get("refresh_token") # Note: Only sent on first consent
 
         # 3. Get User Details (to fill your new fields)
-        user_res = await client.get(
-            USER_INFO_URL,
-            headers={"Authorization": f"Bearer {access_token}"}
-        )
-        user_data = user_res.json() if user_res.status_code == 200 else {}
+        # Profile details are optional: degrade to empty rather than fail the callback
+        try:
+            user_res = await USER_INFO_UPSTREAM.request(
+                client,
+                "GET",
+                USER_INFO_URL,
+                headers={"Authorization": f"Bearer {access_token}"}
+            )
+            user_data = user_res.json() if user_res.status_code == 200 else {}
+        except (CircuitOpenError, httpx.RequestError):
+            user_data = {}
 
         # 4. Get GSC Sites
-        sites_res = await client.get(
+        sites_res = await SITES_UPSTREAM.request(
+            client,
+            "GET",
             GSC_SITES_URL,
             headers={"Authorization": f"Bearer {access_token}"}
         )
@@ -297,10 +327,12 @@ async def gsc_callback(request: Request, db: Session = Depends(get_db)):
         record.verified = verified
         record.permission_level = permission_level
         record.access_token = access_token
+        record.token_expires_at = token_expiry(token_data)
         
         # Only update refresh_token if Google sent a new one
         if refresh_token:
             record.refresh_token = refresh_token
+            record.refresh_token_invalid = False
             
         # Filling your new fields
         record.google_id = user_data.get("sub")    # 'sub' is the unique Google User ID
@@ -372,6 +404,47 @@ def get_verification_result(
     }
 
 
+@gsc_router.post("/verify-result/batch", response_model=GSCVerificationBatchResult)
+def get_verification_results_batch(
+    data: GSCVerificationBatchRequest,
+    db: Session = Depends(get_db)
+):
+    # Same matching rules as /verify-result: a site can be stored either as the
+    # exact URL Google returned or in its normalized form.
+    candidates = {url: {url, normalize_site(url)} for url in data.site_urls}
+    keys = set().union(*candidates.values())
+
+    # One set-based query: latest record per stored site_url (Postgres DISTINCT ON)
+    query = db.query(GSCVerification).filter(GSCVerification.site_url.in_(keys))
+    if db.get_bind().dialect.name == "postgresql":
+        if distinct_on is not None:
+            query = query.ext(distinct_on(GSCVerification.site_url))
+        else:
+            query = query.distinct(GSCVerification.site_url)
+    records = query.order_by(GSCVerification.site_url, GSCVerification.created_at.desc()).all()
+
+    # Rows come newest-first per site, so keep the first one seen. That stays correct
+    # on other backends, which get every matching row instead of DISTINCT ON.
+    latest = {}
+    for record in records:
+        latest.setdefault(record.site_url, record)
+
+    results = {}
+    for url, lookups in candidates.items():
+        matches = [latest[key] for key in lookups if key in latest]
+        if not matches:
+            results[url] = None
+            continue
+
+        record = max(matches, key=lambda r: r.created_at)
+        results[url] = {
+            "verified": record.verified,
+            "permission_level": record.permission_level
+        }
+
+    return {"results": results}
+
+
 ####################################################
 
 GOOGLE_TOKEN_URL = "https://oauth2.googleapis.com/token"
@@ -458,8 +531,59 @@ GSC_QUERY_URL = "https://www.googleapis.com/webmasters/v3/sites/{site_url}/searc
 
 TIMEOUT = httpx.Timeout(10.0, connect=5.0)
 
-async def get_access_token(refresh_token: str):
-    """Refreshes the Google OAuth token asynchronously."""
+# Last successful /metrics payload per (site, query body), served while Google's breaker is open.
+# Only small payloads are kept (a 25,000-row response would pin a lot of memory per worker),
+# and entries older than METRICS_STALE_MAX_AGE seconds are never served.
+METRICS_CACHE_SIZE = 256
+METRICS_CACHE_MAX_ROWS = int(os.getenv("GSC_METRICS_CACHE_MAX_ROWS", "1000"))
+METRICS_STALE_MAX_AGE = float(os.getenv("GSC_METRICS_STALE_MAX_AGE", "900"))
+_metrics_cache: "OrderedDict[tuple, tuple[float, dict]]" = OrderedDict()
+
+# Treat access tokens as expired slightly early so they don't lapse mid-request
+TOKEN_EXPIRY_SKEW = timedelta(seconds=60)
+
+# Verified record id -> last time a request needed its token (time.monotonic())
+ACTIVE_SITES: Dict[UUID, float] = {}
+
+# Record id -> the token refresh currently talking to Google for it
+_refresh_in_flight: Dict[UUID, "asyncio.Task[str]"] = {}
+
+def token_expiry(token_data: dict) -> datetime:
+    return datetime.now(timezone.utc) + timedelta(seconds=token_data.get("expires_in", 3600))
+
+def _update_token_fields(record_id: UUID, **values):
+    # Short-lived session of its own, so no pool connection is held while Google is being called
+    db = SessionLocal()
+    try:
+        db.query(GSCVerification).filter(GSCVerification.id == record_id).update(values, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+def _discard_access_token(record_id: UUID, access_token: str):
+    db = SessionLocal()
+    try:
+        # Only clear the token Google rejected, not one a concurrent refresh just stored
+        db.query(GSCVerification).filter(
+            GSCVerification.id == record_id,
+            GSCVerification.access_token == access_token
+        ).update({"access_token": None, "token_expires_at": None}, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+async def refresh_access_token(record_id: UUID, refresh_token: str) -> str:
+    """Refreshes the access token; concurrent callers for the same record share one Google call."""
+    task = _refresh_in_flight.get(record_id)
+    if task is None:
+        task = asyncio.create_task(_refresh_access_token(record_id, refresh_token))
+        _refresh_in_flight[record_id] = task
+        task.add_done_callback(lambda _: _refresh_in_flight.pop(record_id, None))
+    # Shielded so one caller disconnecting doesn't cancel the refresh for the others
+    return await asyncio.shield(task)
+
+async def _refresh_access_token(record_id: UUID, refresh_token: str) -> str:
+    """Refreshes the Google OAuth token asynchronously and caches it on the record."""
     data = {
         "client_id": CLIENT_ID,
         "client_secret": CLIENT_SECRET,
@@ -469,16 +593,64 @@ async def get_access_token(refresh_token: str):
 
     async with httpx.AsyncClient(timeout=TIMEOUT) as client:
         try:
-            resp = await client.post(GOOGLE_TOKEN_URL, data=data)
+            resp = await TOKEN_UPSTREAM.request(client, "POST", GOOGLE_TOKEN_URL, data=data)
             resp.raise_for_status() # Automatically raises exception for 4xx/5xx
-            return resp.json()["access_token"]
         except httpx.HTTPStatusError as e:
             # Handle specific Google Auth errors
-            error_detail = e.response.json().get("error_description", "Token refresh failed")
+            error_body = e.response.json()
+            if error_body.get("error") == "invalid_grant":
+                # Refresh token is revoked or expired: remember it so later requests fail fast
+                await run_in_threadpool(_update_token_fields, record_id, refresh_token_invalid=True)
+            error_detail = error_body.get("error_description", "Token refresh failed")
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=error_detail)
         except httpx.RequestError:
             raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Google Auth service unreachable")
 
+    token_data = resp.json()
+    await run_in_threadpool(
+        _update_token_fields,
+        record_id,
+        access_token=token_data["access_token"],
+        token_expires_at=token_expiry(token_data)
+    )
+    return token_data["access_token"]
+
+async def get_access_token(record: GSCVerification) -> str:
+    """Returns a usable access token, refreshing only when the cached one is about to expire."""
+    if record.refresh_token_invalid:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Google access for this site was revoked. Please verify the site again."
+        )
+
+    # Lets the background refresher keep this site's token warm
+    ACTIVE_SITES[record.id] = time.monotonic()
+
+    expires_at = record.token_expires_at
+    if record.access_token and expires_at and expires_at > datetime.now(timezone.utc) + TOKEN_EXPIRY_SKEW:
+        return record.access_token
+
+    return await refresh_access_token(record.id, record.refresh_token)
+
+def _find_verified_record(db: Session, site_url: str) -> Optional[GSCVerification]:
+    try:
+        record = db.query(GSCVerification).filter(
+            GSCVerification.site_url == site_url,
+            GSCVerification.verified == True
+        ).first()
+
+        if not record:
+            clean = normalize_site(site_url)
+            record = db.query(GSCVerification).filter(
+                GSCVerification.site_url.contains(clean),
+                GSCVerification.verified == True
+            ).first()
+
+        return record
+    finally:
+        # Give the pool connection back before waiting on Google; the record stays readable
+        db.close()
+
 @gsc_router.get("/metrics")
 async def get_gsc_metrics(
     site_url: str = Query(...),
@@ -492,26 +664,13 @@ async def get_gsc_metrics(
 
     if start_date > end_date:
         raise HTTPException(status_code=400, detail="start_date must be before end_date")
-    # 1. Database Lookup (Remains synchronous as SQLAlchemy/Postgres drivers usually are)
-    record = db.query(GSCVerification).filter(
-        GSCVerification.site_url == site_url,
-        GSCVerification.verified == True
-    ).first()
-
-    if not record:
-        clean = normalize_site(site_url)
-        record = db.query(GSCVerification).filter(
-            GSCVerification.site_url.contains(clean),
-            GSCVerification.verified == True
-        ).first()
+    # 1. Database Lookup (in the threadpool, so a busy pool never stalls the event loop)
+    record = await run_in_threadpool(_find_verified_record, db, site_url)
 
     if not record:
         raise HTTPException(status_code=404, detail="Site not verified or record not found")
 
-    # 2. Asynchronous Token Refresh
-    access_token = await get_access_token(record.refresh_token)
-
-    # 3. Request Preparation
+    # 2. Request Preparation
     final_dimensions = [d for d in dimensions if d != "query"] if search_type in ["discover", "googleNews"] else dimensions
 
     body = {
@@ -521,28 +680,52 @@ async def get_gsc_metrics(
         "type": search_type,
         "rowLimit": row_limit
     }
+    cache_key = (record.site_url, json.dumps(body, sort_keys=True))
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    try:
+        # 3. Access Token (cached on the record, refreshed only near expiry)
+        access_token = await get_access_token(record)
 
-    # 4. Asynchronous API Call with Connection Pooling
-    async with httpx.AsyncClient(timeout=TIMEOUT) as client:
-        encoded_site = quote(record.site_url, safe="")
-        url = GSC_QUERY_URL.format(site_url=encoded_site)
-        
-        try:
-            resp = await client.post(url, headers=headers, json=body)
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        }
+
+        # 4. Asynchronous API Call (breaker-guarded, optionally hedged)
+        async with httpx.AsyncClient(timeout=TIMEOUT) as client:
+            encoded_site = quote(record.site_url, safe="")
+            url = GSC_QUERY_URL.format(site_url=encoded_site)
+
+            resp = await QUERY_UPSTREAM.request(client, "POST", url, headers=headers, json=body)
+
+            if resp.status_code == 401:
+                # Google rejected the cached token before its expiry: drop it and retry once with a new one
+                await run_in_threadpool(_discard_access_token, record.id, access_token)
+                access_token = await refresh_access_token(record.id, record.refresh_token)
+                headers["Authorization"] = f"Bearer {access_token}"
+                resp = await QUERY_UPSTREAM.request(client, "POST", url, headers=headers, json=body)
 
             resp.raise_for_status()
-            return resp.json()
-            
-        except httpx.HTTPStatusError as e:
-            # Pass the GSC specific error (like 403 permissions) back to the user
-            raise HTTPException(status_code=e.response.status_code, detail=e.response.json())
-        except httpx.RequestError:
-            raise HTTPException(status_code=503, detail="Search Console API is currently unavailable")
+
+    except CircuitOpenError:
+        # Google is degraded: serve the last good answer for this exact query if we have one
+        cached = _metrics_cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] <= METRICS_STALE_MAX_AGE:
+            return JSONResponse(cached[1], headers={"X-GSC-Cache": "stale"})
+        raise
+    except httpx.HTTPStatusError as e:
+        # Pass the GSC specific error (like 403 permissions) back to the user
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.json())
+    except httpx.RequestError:
+        raise HTTPException(status_code=503, detail="Search Console API is currently unavailable")
+
+    data = resp.json()
+    if len(data.get("rows", [])) <= METRICS_CACHE_MAX_ROWS:
+        _metrics_cache[cache_key] = (time.monotonic(), data)
+        _metrics_cache.move_to_end(cache_key)
+        if len(_metrics_cache) > METRICS_CACHE_SIZE:
+            _metrics_cache.popitem(last=False)
+    return data
 
         
         
@@ -598,6 +781,7 @@ async def disconnect_gsc_site(
                 print(f"Token revocation failed (already revoked?): {e}")
 
     # 3. Delete from Database
+    ACTIVE_SITES.pop(record.id, None)
     try:
         db.delete(record)
         db.commit()
@@ -1,5 +1,5 @@
-from pydantic import BaseModel, AnyUrl
-from typing import Optional
+from pydantic import BaseModel, AnyUrl, Field
+from typing import Dict, List, Optional
 from uuid import UUID
 
 class GSCVerificationCreate(BaseModel):
@@ -16,3 +16,14 @@ class GSCVerificationDB(GSCVerificationResult):
 
     class Config:
         from_attributes = True
+
+class GSCVerificationBatchRequest(BaseModel):
+    site_urls: List[str] = Field(..., min_length=1, max_length=1000)
+
+class GSCVerificationStatus(BaseModel):
+    verified: bool
+    permission_level: Optional[str] = None
+
+class GSCVerificationBatchResult(BaseModel):
+    # Keyed by the site_url exactly as it was sent; null when no record exists
+    results: Dict[str, Optional[GSCVerificationStatus]]
@@ -0,0 +1,4 @@
+import os, tempfile
+
+# Point db.py at a throwaway SQLite file before any app module creates the engine
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/gsc_test.db")
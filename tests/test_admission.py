@@ -0,0 +1,94 @@
+import asyncio
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import admission
+from admission import AdmissionControlMiddleware, AdmissionController
+
+
+def make_app(controller):
+    app = FastAPI()
+    app.add_middleware(AdmissionControlMiddleware, controller=controller)
+
+    @app.get("/api/v1/gsc/metrics")
+    async def metrics(site_url: str):
+        return {"site_url": site_url}
+
+    @app.get("/api/v1/gsc/callback")
+    async def callback():
+        return {"status": "success"}
+
+    return app
+
+
+def test_rejections_report_queue_wait(monkeypatch):
+    monkeypatch.setattr(admission, "TENANT_CONCURRENCY", 1)
+    monkeypatch.setattr(admission, "TENANT_QUEUE", 0)
+    controller = AdmissionController()
+
+    async def scenario():
+        async with controller.slot("example.com"):
+            client = TestClient(make_app(controller))
+            return await asyncio.to_thread(
+                client.get, "/api/v1/gsc/metrics", params={"site_url": "https://www.example.com/"}
+            )
+
+    resp = asyncio.run(scenario())
+    assert resp.status_code == 429
+    assert resp.headers["Retry-After"] == "1"
+    assert "X-Queue-Wait-Ms" in resp.headers
+    assert controller.shed["tenant"] == 1
+
+
+def test_global_overload_sheds_with_503(monkeypatch):
+    monkeypatch.setattr(admission, "MAX_CONCURRENCY", 1)
+    monkeypatch.setattr(admission, "MAX_QUEUE", 0)
+    controller = AdmissionController()
+
+    async def scenario():
+        async with controller.slot(None):
+            client = TestClient(make_app(controller))
+            metrics = await asyncio.to_thread(
+                client.get, "/api/v1/gsc/metrics", params={"site_url": "https://example.com/"}
+            )
+            callback = await asyncio.to_thread(client.get, "/api/v1/gsc/callback")
+            return metrics, callback
+
+    metrics, callback = asyncio.run(scenario())
+    assert metrics.status_code == 503
+    assert "X-Queue-Wait-Ms" in metrics.headers
+    # The OAuth redirect is never shed
+    assert callback.status_code == 200
+
+
+def test_cancelled_waiter_returns_its_tenant_slot(monkeypatch):
+    monkeypatch.setattr(admission, "MAX_CONCURRENCY", 1)
+    controller = AdmissionController()
+
+    async def wait_for_slot():
+        async with controller.slot("a.com"):
+            pass
+
+    async def scenario():
+        async with controller.slot(None):
+            waiter = asyncio.create_task(wait_for_slot())
+            await asyncio.sleep(0.01)
+            assert controller.global_gate.waiting == 1
+            waiter.cancel()
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                pass
+
+    asyncio.run(scenario())
+    assert "a.com" not in controller.tenant_gates
+    assert controller.global_gate.active == 0
+
+    # The site can still get a full set of slots afterwards
+    async def fill_tenant():
+        async with controller.slot("a.com"):
+            gate = controller.tenant_gates["a.com"]
+            assert gate.semaphore._value == admission.TENANT_CONCURRENCY - 1
+
+    asyncio.run(fill_tenant())
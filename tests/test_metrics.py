@@ -0,0 +1,155 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import router
+from db import SessionLocal
+from main import app
+from models import GSCVerification
+
+SITE = "https://example.com/"
+
+
+@pytest.fixture
+def verified_site():
+    db = SessionLocal()
+    record = GSCVerification(site_url=SITE, verified=True, refresh_token="refresh")
+    db.add(record)
+    db.commit()
+    yield record
+    db.delete(record)
+    db.commit()
+    db.close()
+
+
+def route_httpx(monkeypatch, handler):
+    """Sends every outgoing httpx call to a mock Google."""
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(
+        httpx, "AsyncClient",
+        lambda **kwargs: real_client(transport=httpx.MockTransport(handler), **kwargs)
+    )
+
+
+@pytest.fixture
+def google(monkeypatch):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(200, json={"rows": [{"keys": ["gsc"], "clicks": 3}]})
+
+    route_httpx(monkeypatch, handler)
+
+    async def fake_access_token(*args, **kwargs):
+        return "access"
+
+    monkeypatch.setattr(router, "get_access_token", fake_access_token)
+    monkeypatch.setattr(router, "_metrics_cache", router.OrderedDict())
+
+    breaker = router.QUERY_UPSTREAM.breaker
+    yield calls
+    breaker.record_success()
+
+
+def open_query_breaker():
+    breaker = router.QUERY_UPSTREAM.breaker
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+
+
+def test_metrics_serves_stale_cache_while_breaker_open(verified_site, google):
+    client = TestClient(app)
+    params = {"site_url": SITE, "start_date": "2026-01-01", "end_date": "2026-02-01"}
+
+    fresh = client.get("/api/v1/gsc/metrics", params=params)
+    assert fresh.status_code == 200
+    assert "X-GSC-Cache" not in fresh.headers
+
+    open_query_breaker()
+
+    stale = client.get("/api/v1/gsc/metrics", params=params)
+    assert stale.status_code == 200
+    assert stale.headers["X-GSC-Cache"] == "stale"
+    assert stale.json() == fresh.json()
+    assert len(google) == 1
+
+    # Nothing cached for a different query: fail fast instead of waiting on Google
+    uncached = client.get("/api/v1/gsc/metrics", params={**params, "end_date": "2026-03-01"})
+    assert uncached.status_code == 503
+    assert int(uncached.headers["Retry-After"]) >= 1
+    assert len(google) == 1
+
+
+def test_metrics_retries_once_when_google_rejects_the_token(verified_site, monkeypatch):
+    minted = []
+    queries = []
+
+    async def handler(request):
+        if request.url.host == "oauth2.googleapis.com":
+            minted.append(f"token-{len(minted) + 1}")
+            return httpx.Response(200, json={"access_token": minted[-1], "expires_in": 3599})
+
+        queries.append(request.headers["Authorization"])
+        # Google revoked the first token early
+        if request.headers["Authorization"] == "Bearer token-1":
+            return httpx.Response(401, json={"error": {"code": 401}})
+        return httpx.Response(200, json={"rows": []})
+
+    route_httpx(monkeypatch, handler)
+    monkeypatch.setattr(router, "_metrics_cache", router.OrderedDict())
+
+    resp = TestClient(app).get(
+        "/api/v1/gsc/metrics",
+        params={"site_url": SITE, "start_date": "2026-01-01", "end_date": "2026-02-01"}
+    )
+
+    assert resp.status_code == 200
+    assert queries == ["Bearer token-1", "Bearer token-2"]
+    db = SessionLocal()
+    try:
+        assert db.get(GSCVerification, verified_site.id).access_token == "token-2"
+    finally:
+        db.close()
+
+
+def test_concurrent_refreshes_share_one_google_call(verified_site, monkeypatch):
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json={"access_token": "shared", "expires_in": 3599})
+
+    route_httpx(monkeypatch, handler)
+
+    async def scenario():
+        return await asyncio.gather(
+            *(router.refresh_access_token(verified_site.id, "refresh") for _ in range(5))
+        )
+
+    assert asyncio.run(scenario()) == ["shared"] * 5
+    assert len(calls) == 1
+    assert router._refresh_in_flight == {}
+
+
+def test_stale_cache_expires(verified_site, google, monkeypatch):
+    client = TestClient(app)
+    params = {"site_url": SITE, "start_date": "2026-01-01", "end_date": "2026-02-01"}
+    assert client.get("/api/v1/gsc/metrics", params=params).status_code == 200
+
+    monkeypatch.setattr(router, "METRICS_STALE_MAX_AGE", 0)
+    open_query_breaker()
+
+    assert client.get("/api/v1/gsc/metrics", params=params).status_code == 503
+
+
+def test_large_payloads_are_not_cached(verified_site, google, monkeypatch):
+    monkeypatch.setattr(router, "METRICS_CACHE_MAX_ROWS", 0)
+    client = TestClient(app)
+    params = {"site_url": SITE, "start_date": "2026-01-01", "end_date": "2026-02-01"}
+
+    assert client.get("/api/v1/gsc/metrics", params=params).status_code == 200
+    assert len(router._metrics_cache) == 0
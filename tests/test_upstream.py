@@ -0,0 +1,216 @@
+import asyncio
+
+import httpx
+import pytest
+
+import upstream
+from upstream import CircuitBreaker, CircuitOpenError, Upstream
+
+
+def make_upstream(handler, hedge=False, failure_threshold=2, recovery_timeout=0.05):
+    up = Upstream("test", hedge=hedge)
+    up.breaker = CircuitBreaker("test", failure_threshold=failure_threshold, recovery_timeout=recovery_timeout)
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return up, client
+
+
+def test_breaker_opens_then_recovers_through_half_open():
+    status_code = {"value": 503}
+
+    async def handler(request):
+        return httpx.Response(status_code["value"])
+
+    async def scenario():
+        up, client = make_upstream(handler)
+        async with client:
+            for _ in range(2):
+                await up.request(client, "GET", "https://upstream.test/")
+            assert up.breaker.state == CircuitBreaker.OPEN
+
+            with pytest.raises(CircuitOpenError) as err:
+                await up.request(client, "GET", "https://upstream.test/")
+            assert err.value.retry_after >= 1
+
+            # Failed probe reopens the breaker
+            await asyncio.sleep(0.06)
+            await up.request(client, "GET", "https://upstream.test/")
+            assert up.breaker.state == CircuitBreaker.OPEN
+
+            # Successful probe closes it
+            await asyncio.sleep(0.06)
+            status_code["value"] = 200
+            resp = await up.request(client, "GET", "https://upstream.test/")
+            assert resp.status_code == 200
+            assert up.breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_client_errors_do_not_trip_breaker():
+    async def handler(request):
+        return httpx.Response(403)
+
+    async def scenario():
+        up, client = make_upstream(handler)
+        async with client:
+            for _ in range(5):
+                await up.request(client, "GET", "https://upstream.test/")
+        assert up.breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_only_one_half_open_probe_gets_through():
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200)
+
+    async def scenario():
+        up, client = make_upstream(handler, failure_threshold=1)
+        up.breaker.record_failure()
+        await asyncio.sleep(0.06)
+
+        async with client:
+            results = await asyncio.gather(
+                *(up.request(client, "GET", "https://upstream.test/") for _ in range(3)),
+                return_exceptions=True,
+            )
+
+        assert sum(isinstance(r, httpx.Response) for r in results) == 1
+        assert sum(isinstance(r, CircuitOpenError) for r in results) == 2
+        assert len(calls) == 1
+        assert up.breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_hedge_fires_after_threshold_and_loser_is_cancelled(monkeypatch):
+    monkeypatch.setattr(upstream, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(upstream, "HEDGE_DEFAULT_DELAY", 0.05)
+    monkeypatch.setattr(upstream, "HEDGE_BUDGET", 1.0)
+
+    attempts = []
+    cancelled = []
+
+    async def handler(request):
+        attempt = len(attempts)
+        attempts.append(attempt)
+        if attempt == 0:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                cancelled.append(attempt)
+                raise
+        return httpx.Response(200, json={"attempt": attempt})
+
+    async def scenario():
+        up, client = make_upstream(handler, hedge=True)
+        async with client:
+            resp = await up.request(client, "GET", "https://upstream.test/")
+            await asyncio.sleep(0)
+
+        assert resp.json() == {"attempt": 1}
+        assert cancelled == [0]
+        # The losing attempt's time still counts towards the hedge threshold
+        assert len(up.latency.samples) == 2
+        assert max(up.latency.samples) >= 0.05
+
+    asyncio.run(scenario())
+
+
+def test_hedge_respects_budget(monkeypatch):
+    monkeypatch.setattr(upstream, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(upstream, "HEDGE_DEFAULT_DELAY", 0.01)
+    monkeypatch.setattr(upstream, "HEDGE_BUDGET", 0.1)
+
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        await asyncio.sleep(0.03)
+        return httpx.Response(200)
+
+    async def scenario():
+        up, client = make_upstream(handler, hedge=True)
+        async with client:
+            for _ in range(20):
+                await up.request(client, "GET", "https://upstream.test/")
+
+        assert len(calls) <= 22
+
+    asyncio.run(scenario())
+
+
+def test_half_open_probe_is_not_hedged(monkeypatch):
+    monkeypatch.setattr(upstream, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(upstream, "HEDGE_DEFAULT_DELAY", 0.01)
+    monkeypatch.setattr(upstream, "HEDGE_BUDGET", 1.0)
+
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200)
+
+    async def scenario():
+        up, client = make_upstream(handler, hedge=True, failure_threshold=1)
+        up.hedge_credit = upstream.HEDGE_BURST
+        up.breaker.record_failure()
+        await asyncio.sleep(0.06)
+
+        async with client:
+            await up.request(client, "GET", "https://upstream.test/")
+
+        assert len(calls) == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_caller_cancels_in_flight_attempt(monkeypatch):
+    monkeypatch.setattr(upstream, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(upstream, "HEDGE_DEFAULT_DELAY", 1.0)
+
+    cancelled = []
+
+    async def handler(request):
+        try:
+            await asyncio.sleep(2)
+        except asyncio.CancelledError:
+            cancelled.append(request)
+            raise
+        return httpx.Response(200)
+
+    async def scenario():
+        up, client = make_upstream(handler, hedge=True)
+        async with client:
+            caller = asyncio.create_task(up.request(client, "GET", "https://upstream.test/"))
+            await asyncio.sleep(0.02)
+            caller.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await caller
+            await asyncio.sleep(0)
+
+        assert len(cancelled) == 1
+
+    asyncio.run(scenario())
+
+
+def test_quota_429s_do_not_trip_per_tenant_breakers():
+    async def handler(request):
+        return httpx.Response(429)
+
+    async def scenario():
+        up, client = make_upstream(handler)
+        up.trip_on_429 = False
+        async with client:
+            for _ in range(5):
+                await up.request(client, "GET", "https://upstream.test/")
+        assert up.breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(scenario())
+    assert upstream.QUERY_UPSTREAM.trip_on_429 is False
+    assert upstream.TOKEN_UPSTREAM.trip_on_429 is True
@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi.testclient import TestClient
+
+from db import SessionLocal
+from main import app
+from models import GSCVerification
+
+BATCH_URL = "/api/v1/gsc/verify-result/batch"
+
+
+@pytest.fixture
+def records():
+    """Each site is stored in both its raw and normalized form; the newer row must win."""
+    now = datetime.now(timezone.utc)
+    rows = [
+        # foo.com: newest record is the normalized, unverified one
+        GSCVerification(site_url="https://foo.com/", verified=True, permission_level="siteOwner",
+                        created_at=now - timedelta(days=2)),
+        GSCVerification(site_url="foo.com", verified=False, created_at=now - timedelta(days=1)),
+        # bar.com: newest record is the raw, verified one
+        GSCVerification(site_url="bar.com", verified=False, created_at=now - timedelta(days=2)),
+        GSCVerification(site_url="https://bar.com/", verified=True, permission_level="siteFullUser",
+                        created_at=now - timedelta(days=1)),
+        GSCVerification(site_url="https://bar.com/", verified=False, created_at=now - timedelta(days=3)),
+    ]
+    db = SessionLocal()
+    db.add_all(rows)
+    db.commit()
+    yield rows
+    for row in rows:
+        db.delete(row)
+    db.commit()
+    db.close()
+
+
+def test_batch_picks_newest_record_across_raw_and_normalized_forms(records):
+    resp = TestClient(app).post(BATCH_URL, json={"site_urls": ["https://foo.com/", "https://bar.com/"]})
+
+    assert resp.status_code == 200
+    assert resp.json()["results"] == {
+        "https://foo.com/": {"verified": False, "permission_level": None},
+        "https://bar.com/": {"verified": True, "permission_level": "siteFullUser"},
+    }
+
+
+def test_batch_maps_unknown_sites_to_null(records):
+    resp = TestClient(app).post(BATCH_URL, json={"site_urls": ["https://unknown.example/", "foo.com"]})
+
+    assert resp.status_code == 200
+    results = resp.json()["results"]
+    assert results["https://unknown.example/"] is None
+    assert results["foo.com"] == {"verified": False, "permission_level": None}
+
+
+@pytest.mark.parametrize("site_urls", [[], [f"https://site{i}.com/" for i in range(1001)]])
+def test_batch_rejects_empty_or_oversized_lists(site_urls):
+    resp = TestClient(app).post(BATCH_URL, json={"site_urls": site_urls})
+
+    assert resp.status_code == 422
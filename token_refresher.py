@@ -0,0 +1,133 @@
+import asyncio, logging, os, random, time
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from uuid import UUID
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+
+from db import SessionLocal
+from models import GSCVerification
+from router import ACTIVE_SITES, refresh_access_token
+from upstream import CircuitOpenError
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Opt-in: the shipped deployment (vercel.json) is serverless, where neither this loop nor
+# the in-memory ACTIVE_SITES survives between invocations. Enable it on long-running servers.
+REFRESHER_ENABLED = os.getenv("GSC_TOKEN_REFRESHER_ENABLED", "false").lower() in ("1", "true", "yes")
+REFRESH_INTERVAL = float(os.getenv("GSC_TOKEN_REFRESH_INTERVAL", "30"))
+# Renew tokens expiring within REFRESH_AHEAD + a random share of REFRESH_JITTER seconds
+REFRESH_AHEAD = float(os.getenv("GSC_TOKEN_REFRESH_AHEAD", "300"))
+REFRESH_JITTER = float(os.getenv("GSC_TOKEN_REFRESH_JITTER", "120"))
+# Sites not used by a request for this long stop being kept warm
+ACTIVE_WINDOW = float(os.getenv("GSC_TOKEN_ACTIVE_WINDOW", "1800"))
+REFRESH_CONCURRENCY = int(os.getenv("GSC_TOKEN_REFRESH_CONCURRENCY", "4"))
+
+
+class TokenRefresher:
+    """Renews access tokens of recently used sites before they expire."""
+
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(REFRESH_CONCURRENCY)
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if REFRESHER_ENABLED and self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(REFRESH_INTERVAL * random.uniform(0.9, 1.1))
+            try:
+                await self.refresh_due()
+            except Exception as e:
+                logger.error(f"Background token refresh failed: {e}")
+
+    async def refresh_due(self):
+        cutoff = time.monotonic() - ACTIVE_WINDOW
+        for record_id, last_used in list(ACTIVE_SITES.items()):
+            if last_used < cutoff:
+                ACTIVE_SITES.pop(record_id, None)
+
+        if not ACTIVE_SITES:
+            return
+
+        now = datetime.now(timezone.utc)
+        horizon = now + timedelta(seconds=REFRESH_AHEAD + REFRESH_JITTER)
+
+        candidates = await run_in_threadpool(_load_candidates, list(ACTIVE_SITES), horizon)
+
+        # Per-site jitter spreads renewals out instead of refreshing every token on the same tick
+        due = [
+            record_id for record_id, expires_at in candidates
+            if expires_at is None
+            or expires_at - now < timedelta(seconds=REFRESH_AHEAD + random.uniform(0, REFRESH_JITTER))
+        ]
+        await asyncio.gather(*(self._refresh(record_id) for record_id in due))
+
+    async def _refresh(self, record_id: UUID):
+        async with self.semaphore:
+            refresh_token = await run_in_threadpool(_load_refresh_token, record_id)
+            if refresh_token is None:
+                ACTIVE_SITES.pop(record_id, None)
+                return
+
+            try:
+                await refresh_access_token(record_id, refresh_token)
+            except HTTPException as e:
+                logger.warning(f"Could not refresh token for {record_id}: {e.detail}")
+                if e.status_code == 401:
+                    # Dead or rejected grant: stop keeping it warm until a request uses it again
+                    ACTIVE_SITES.pop(record_id, None)
+            except CircuitOpenError:
+                # Google's token endpoint is degraded; try again on a later tick
+                pass
+
+
+# The DB helpers below run in the threadpool with short sessions, so the event loop
+# never blocks on a pool checkout and no connection is held across a call to Google.
+
+def _load_candidates(record_ids: List[UUID], horizon: datetime):
+    db = SessionLocal()
+    try:
+        return (
+            db.query(GSCVerification.id, GSCVerification.token_expires_at)
+            .filter(
+                GSCVerification.id.in_(record_ids),
+                GSCVerification.verified == True,
+                GSCVerification.refresh_token.isnot(None),
+                GSCVerification.refresh_token_invalid.isnot(True),
+                (GSCVerification.token_expires_at.is_(None)) |
+                (GSCVerification.token_expires_at < horizon)
+            )
+            .all()
+        )
+    finally:
+        db.close()
+
+
+def _load_refresh_token(record_id: UUID) -> Optional[str]:
+    db = SessionLocal()
+    try:
+        record = db.get(GSCVerification, record_id)
+        if record is None or record.refresh_token_invalid:
+            return None
+        return record.refresh_token
+    finally:
+        db.close()
+
+
+token_refresher = TokenRefresher()
@@ -0,0 +1,181 @@
+import asyncio, os, time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Circuit breaker tuning (per upstream)
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("GSC_BREAKER_FAILURES", "5"))
+BREAKER_RECOVERY_SECONDS = float(os.getenv("GSC_BREAKER_RECOVERY_SECONDS", "30"))
+
+# Hedged requests are opt-in: they trade extra upstream quota for a shorter tail
+HEDGE_ENABLED = os.getenv("GSC_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.getenv("GSC_HEDGE_PERCENTILE", "0.95"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("GSC_HEDGE_DEFAULT_DELAY", "1.0"))
+HEDGE_MIN_SAMPLES = 20
+# Share of requests allowed to send a hedge, so a degraded upstream isn't hit twice for every read
+HEDGE_BUDGET = float(os.getenv("GSC_HEDGE_BUDGET", "0.05"))
+HEDGE_BURST = 5
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose breaker is open."""
+
+    def __init__(self, upstream: str, retry_after: int):
+        super().__init__(f"{upstream} is temporarily unavailable")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        recovery_timeout: float = BREAKER_RECOVERY_SECONDS,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def before_call(self):
+        """Fails fast while open; lets a single probe through once the cool-down has passed."""
+        if self.state == self.CLOSED:
+            return
+
+        elapsed = time.monotonic() - self.opened_at
+        if self.state == self.OPEN and elapsed >= self.recovery_timeout:
+            self.state = self.HALF_OPEN
+
+        if self.state == self.HALF_OPEN and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return
+
+        retry_after = max(1, int(self.recovery_timeout - elapsed + 0.999))
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        # Call was abandoned (e.g. client disconnected) without an outcome
+        self.probe_in_flight = False
+
+
+class LatencyTracker:
+    def __init__(self, window: int = 200):
+        self.samples = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+class Upstream:
+    """A Google endpoint guarded by its own circuit breaker and latency history."""
+
+    def __init__(self, name: str, hedge: bool = False, trip_on_429: bool = True):
+        self.name = name
+        self.hedge = hedge
+        self.trip_on_429 = trip_on_429
+        self.breaker = CircuitBreaker(name)
+        self.latency = LatencyTracker()
+        self.hedge_credit = 0.0
+
+    async def request(self, client: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response:
+        self.breaker.before_call()
+
+        send = lambda: client.request(method, url, **kwargs)
+        # Never hedge the half-open probe: recovery is decided by exactly one call
+        hedge = self.hedge and HEDGE_ENABLED and self.breaker.state == CircuitBreaker.CLOSED
+        if hedge:
+            self.hedge_credit = min(HEDGE_BURST, self.hedge_credit + HEDGE_BUDGET)
+        try:
+            if hedge:
+                resp = await self._hedged(send)
+            else:
+                resp = await self._timed(send)
+        except httpx.RequestError:
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+
+        # Only upstream-side trouble trips the breaker; 4xx are the caller's problem
+        if resp.status_code >= 500 or (resp.status_code == 429 and self.trip_on_429):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return resp
+
+    async def _timed(self, send: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        started = time.monotonic()
+        try:
+            return await send()
+        finally:
+            # Also record attempts that failed or lost a hedge race; dropping the slow
+            # ones would drag the percentile (and so the hedge delay) down during an outage
+            self.latency.observe(time.monotonic() - started)
+
+    async def _hedged(self, send: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        delay = self.latency.percentile(HEDGE_PERCENTILE) or HEDGE_DEFAULT_DELAY
+
+        pending = {asyncio.create_task(self._timed(send))}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return done.pop().result()
+
+            if self.hedge_credit < 1:
+                # Out of hedge budget: just wait for the first attempt
+                done, pending = await asyncio.wait(pending)
+                return done.pop().result()
+
+            # First attempt is slower than usual: race a second one against it
+            self.hedge_credit -= 1
+            pending.add(asyncio.create_task(self._timed(send)))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+TOKEN_UPSTREAM = Upstream("google_token")
+USER_INFO_UPSTREAM = Upstream("google_userinfo")
+# Search Console 429s are per-site/per-user quota errors, so one noisy tenant
+# must not open the shared breaker for everyone else
+SITES_UPSTREAM = Upstream("gsc_sites", hedge=True, trip_on_429=False)
+QUERY_UPSTREAM = Upstream("gsc_search_analytics", hedge=True, trip_on_429=False)